@@ -1,80 +1,174 @@
 #CSCI 185 - Web and Data Mining
 
-from sklearn.preprocessing import MinMaxScaler
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-import os
+import io
+import warnings
+from pathlib import Path
 
 #Reading in Data
-try: os.chdir('data')    
-except:
-    pass
-
-#These files have footers
-df_Expend = pd.read_csv('../data/Expenditure_Data.txt', skipfooter = 5, engine = 'python')
-df_Salary = pd.read_csv('../data/Salary_Data.txt', skipfooter = 5, engine = 'python')
-df_CA = pd.read_csv('../data/Chronic_Absent.txt', sep = '|')
-
-#Does not contain footers
-df_Test_Scores = pd.read_csv('../data/Test_Score_Results.txt', sep = '\t')
-
-
-#Updating Columns to be the same format
-df_Salary.columns = df_Salary.columns.str.upper()
-df_Expend.columns = df_Expend.columns.str.upper()
-df_Test_Scores.columns = df_Test_Scores.columns.str.upper()
-df_CA.columns = df_CA.columns.str.upper()
-
-#Pre-Processing
-
-#Data Reduction
-#3 Values STEXP, DSAL, STSAL
-df_Expend.drop(['SARCYEAR','C', 'D', 'S', 'STEXP'], axis = 1,inplace=True)
-
-#3 Values BTCHSAL, MTCHSAL, HTCHSAL
-df_Salary = df_Salary[['CDSCODE', 'BTCHSAL', 'MTCHSAL','HTCHSAL']]
-
-#4 Values SELA_Y2, SMATH_Y2, DELA_Y2, DMATH_Y2
-df_Test_Scores = df_Test_Scores[['CDSCODE','SELA_Y2', 'SMATH_Y2','DELA_Y2','DMATH_Y2']]
-
-#1 Value PERSD
-df_SED = pd.read_csv('../data/Subgroup_Data.txt', usecols = ['CDSCODE', 'PERSD'])
-
-# Values RALL, REL,RSED
-df_CA = df_CA[['CDSCODE', 'RALL', 'REL', 'RSED', ]]
-
-#Since we are looking for correlations for test scores we use NaN for missing test score
-#values. When we merge, we will remove any row that has NaN values
-df_Test_Scores.replace(['--','0'], np.nan, inplace=True)
-
-#Filling in NaN values since there is a possibility there are test scores but 0 SED #students
-df_SED.replace([np.nan], 0, inplace=True)
-
-#Filling NaN values with Means
-df_Expend.fillna(df_Expend.mean(numeric_only = True),inplace=True)
-df_Salary.fillna(df_Salary.mean(numeric_only = True),inplace=True)
-
-#List of all Data Frames
-#Keep adding data frames to here after reduction
-data_frames = [df_Expend, df_Salary, df_Test_Scores, df_SED, df_CA]
-
-#Merging all DataFrames
-df_merge = df_Expend.merge(df_Salary).merge(df_Test_Scores).merge(df_SED).merge(df_CA)
-
-#Removing NaN values
-df_merge.dropna(inplace=True)
-
-#Normalizing attributes with values in the thousands
-scaler = MinMaxScaler()
-
-#Insert Attributes to Normalize
-columns_to_normalize = ['DSAL', 'STSAL', 'BTCHSAL', 'MTCHSAL', 'HTCHSAL']
-
-#Normalize
-df_merge[columns_to_normalize] = scaler.fit_transform(df_merge[columns_to_normalize])
-
-print(df_merge.corr())
-
-plt.matshow(df_merge.corr())
-plt.show()
\ No newline at end of file
+#The data folder is found from this file's location, so the script can be run from any directory
+DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+
+#Reads a csv file that ends in a footer of the given number of lines
+#The footer is cut off the raw bytes so the C parser can be used, skipfooter
+#only works with the much slower python engine
+def read_csv_without_footer(path, footer = 5, **kwargs):
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    #Walking back from the end of the file to the newline that ends the last data row
+    end = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(footer):
+        end = data.rfind(b'\n', 0, end)
+
+    return pd.read_csv(io.BytesIO(data[:end + 1]), **kwargs)
+
+#Data files the merged DataFrame is built from, this script is included so
+#changes to the pre-processing below also invalidate the cache
+SOURCES = [DATA_DIR / 'Expenditure_Data.txt', DATA_DIR / 'Salary_Data.txt', DATA_DIR / 'Chronic_Absent.txt',
+           DATA_DIR / 'Test_Score_Results.txt', DATA_DIR / 'Subgroup_Data.txt', Path(__file__)]
+
+#Cached copy of the merged DataFrame so reruns skip reading and pre-processing
+CACHE = DATA_DIR / 'df_merge.pkl'
+
+#Warns about rows dropped for a repeated CDSCODE, the messages are kept with the
+#DataFrame so they are repeated when it comes from the cache
+def warn_dropped_duplicates(df_merge):
+    for message in df_merge.attrs.get('dropped_duplicates', []):
+        warnings.warn(message, stacklevel = 3)
+
+#Reads, pre-processes and merges all data files, reusing the cache when it is
+#newer than every source
+def load_data():
+    if CACHE.exists() and CACHE.stat().st_mtime > max(src.stat().st_mtime for src in SOURCES):
+        #A cache that cannot be read, e.g. written by another pandas version, is rebuilt below
+        try:
+            df_merge = pd.read_pickle(CACHE)
+        except Exception as error:
+            warnings.warn(f'Rebuilding the unreadable cache {CACHE}: {error}')
+        else:
+            warn_dropped_duplicates(df_merge)
+            return df_merge
+
+    #Data Reduction
+    #Only the columns used in the analysis are parsed, straight into float32 columns
+    #CDSCODE is parsed as int64 so the join on it hashes integers
+
+    #These files have footers
+    #2 Values DSAL, STSAL
+    df_Expend = read_csv_without_footer(DATA_DIR / 'Expenditure_Data.txt', usecols = ['CDSCODE', 'DSAL', 'STSAL'],
+                                        dtype = {'CDSCODE': np.int64, 'DSAL': np.float32, 'STSAL': np.float32})
+
+    #3 Values BTCHSAL, MTCHSAL, HTCHSAL
+    df_Salary = read_csv_without_footer(DATA_DIR / 'Salary_Data.txt', usecols = ['CDSCode', 'BTCHSAL', 'MTCHSAL', 'HTCHSAL'],
+                                        dtype = {'CDSCode': np.int64, 'BTCHSAL': np.float32, 'MTCHSAL': np.float32, 'HTCHSAL': np.float32})
+
+    #Does not contain footers
+    #3 Values RALL, REL, RSED
+    df_CA = pd.read_csv(DATA_DIR / 'Chronic_Absent.txt', sep = '|', usecols = ['CDSCode', 'RALL', 'REL', 'RSED'],
+                        dtype = {'CDSCode': np.int64, 'RALL': np.float32, 'REL': np.float32, 'RSED': np.float32})
+
+    #4 Values SELA_Y2, SMATH_Y2, DELA_Y2, DMATH_Y2
+    #Since we are looking for correlations for test scores we use NaN for missing test score
+    #values. When we merge, we will remove any row that has NaN values
+    df_Test_Scores = pd.read_csv(DATA_DIR / 'Test_Score_Results.txt', sep = '\t',
+                                 usecols = ['CDSCode', 'SELA_Y2', 'SMATH_Y2', 'DELA_Y2', 'DMATH_Y2'],
+                                 na_values = ['--', '0'],
+                                 dtype = {'CDSCode': np.int64, 'SELA_Y2': np.float32, 'SMATH_Y2': np.float32,
+                                          'DELA_Y2': np.float32, 'DMATH_Y2': np.float32})
+
+    #1 Value PERSD
+    df_SED = pd.read_csv(DATA_DIR / 'Subgroup_Data.txt', usecols = ['CDSCODE', 'PERSD'],
+                         dtype = {'CDSCODE': np.int64, 'PERSD': np.float32})
+
+    #Updating Columns to be the same format
+    df_Salary.columns = df_Salary.columns.str.upper()
+    df_Test_Scores.columns = df_Test_Scores.columns.str.upper()
+    df_CA.columns = df_CA.columns.str.upper()
+
+    #Pre-Processing
+
+    #Filling in NaN values since there is a possibility there are test scores but 0 SED #students
+    df_SED['PERSD'] = df_SED['PERSD'].fillna(0)
+
+    #Filling NaN values with Means, computed on the numeric values as one array per DataFrame
+    for df in (df_Expend, df_Salary):
+        columns = df.columns.drop('CDSCODE')
+        values = df[columns].to_numpy()
+        df[columns] = np.where(np.isnan(values), np.nanmean(values, axis = 0), values)
+
+    #List of all Data Frames
+    #Keep adding data frames to here after reduction
+    data_frames = [df_Expend, df_Salary, df_Test_Scores, df_SED, df_CA]
+
+    #Merging all DataFrames
+    #Aligning on CDSCODE in a single inner join instead of chaining merges
+    #A repeated CDSCODE would break the join, so only its first row is kept
+    dropped_duplicates = []
+    indexed_frames = []
+    for df in data_frames:
+        df = df.set_index('CDSCODE')
+        duplicated = df.index.duplicated()
+        if duplicated.any():
+            dropped_duplicates.append(f'Dropped {duplicated.sum()} duplicate CDSCODE rows '
+                                      f'from the frame with columns {list(df.columns)}')
+            df = df[~duplicated]
+        indexed_frames.append(df)
+
+    df_merge = pd.concat(indexed_frames, axis = 1, join = 'inner').reset_index()
+
+    #Removing NaN values
+    df_merge = df_merge.dropna()
+    df_merge.attrs['dropped_duplicates'] = dropped_duplicates
+
+    #Writing to a temporary file first so a run that stops partway never leaves a
+    #truncated cache behind, a cache that cannot be written is skipped
+    temp = CACHE.with_suffix('.tmp')
+    try:
+        df_merge.to_pickle(temp)
+        temp.replace(CACHE)
+    except OSError as error:
+        warnings.warn(f'Could not write the cache {CACHE}: {error}')
+
+    warn_dropped_duplicates(df_merge)
+
+    return df_merge
+
+#Normalizes the given columns to [0, 1] with a min-max scaling done in place on one array
+def minmax_inplace(df, cols):
+    values = df[cols].to_numpy(dtype = np.float32, copy = True)
+    values -= values.min(axis = 0)
+    values /= np.maximum(values.max(axis = 0), 1e-12)
+    df[cols] = values
+
+#Correlation matrix of every attribute, CDSCODE is only an identifier
+#No NaN values are left after dropna, so numpy can correlate all columns in one
+#pass instead of the pairwise NaN handling of DataFrame.corr
+def correlation_matrix(df):
+    columns = df.columns.drop('CDSCODE')
+    return pd.DataFrame(np.corrcoef(df[columns].to_numpy(dtype = np.float32), rowvar = False),
+                        index = columns, columns = columns)
+
+#Running the analysis only when executed as a script, importing this file for
+#its functions does not load matplotlib
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    df_merge = load_data()
+
+    #Normalizing attributes with values in the thousands
+
+    #Insert Attributes to Normalize
+    columns_to_normalize = ['DSAL', 'STSAL', 'BTCHSAL', 'MTCHSAL', 'HTCHSAL']
+
+    #Normalize
+    minmax_inplace(df_merge, columns_to_normalize)
+
+    #Computing the correlation matrix once and reusing it for the plot
+    corr = correlation_matrix(df_merge)
+
+    print(corr)
+
+    plt.matshow(corr)
+    plt.show()
\ No newline at end of file